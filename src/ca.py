@@ -57,6 +57,10 @@ class AbstractRule(ABC):
     array when using the apply function.
     """
 
+    def __repr__(self) -> str:
+        params = ', '.join(f'{name}={value!r}' for name, value in vars(self).items())
+        return f'{self.__class__.__name__}({params})'
+
     @abstractmethod
     def apply(self, state: np.ndarray) -> np.ndarray:
         pass
@@ -110,7 +114,7 @@ class Runner:
         """
         if len(self.history) == 0:
             return np.zeros(self._max_timesteps)
-        history = np.array(self.history)
+        history = np.asarray(self.history)
         #car_speeds = history.
         means = history.mean(axis=(1,2), where=(history >= 0))
         return means / self._street._v_max
@@ -123,7 +127,7 @@ class Runner:
         if len(self.history) == 0:
             return np.zeros(self._max_timesteps)
         percentage = 0.1
-        history = np.array(self.history)
+        history = np.asarray(self.history)
         street_last_stretch = history[:,:, -int(self._street._lane_len * percentage):]
         counts = np.where((street_last_stretch >= 0), 1, 0).sum(axis=(1,2))
         return counts
@@ -135,15 +139,15 @@ class Runner:
         # create in-memory file-like object
         history_compressed = io.BytesIO()
         # save numpy array to file-like object
-        np.savez_compressed(history_compressed, history=np.array(self.history))
+        np.savez_compressed(history_compressed, history=np.asarray(self.history))
         # reset the file pointer to the beginning, so that the file can be read
         # otherwise the next read would start at the end of the file
         # and the file would be seen as empty or corrupted
         history_compressed.seek(0)
 
         # keep only the parameters of the street, not the state
-        street_parameters = self._street.__dict__
-        street_parameters.pop('_state')
+        # (copied, so serializing does not modify the street and can be repeated)
+        street_parameters = {key: value for key, value in self._street.__dict__.items() if key != '_state'}
 
         # keep the list of rules
         rule_list = self._rule_list
@@ -8,26 +8,83 @@ from bokeh.models.formatters import PrintfTickFormatter
 from bokeh.models import FixedTicker
 import param
 import io
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from src.ca import Street, Runner
 from src.rules import *
 
 hv.extension('bokeh')
+# render plots with webgl, to rasterize large street heatmaps on the client GPU
+hv.renderer('bokeh').webgl = True
 pn.extension(notifications=True)
 
 METERS_PER_CELL = 4
+TIMESTEP_THROTTLE_MS = 20
+_BGY_ARR = np.asarray(cc.bgy)
+
+# serializes simulation exports in the background, so plots render before the export is ready
+_export_executor = ThreadPoolExecutor(max_workers=1)
 
 class CurrentRunner(param.Parameterized):
     value = param.Parameter(None)
 
-def gridded_data_from(state: np.ndarray, empty=False) -> dict:
+def gridded_axes_from(street: Street) -> dict:
+    """
+    Returns the x/y axes of the street plot. They only depend on the street's
+    dimensions, so they can be computed once per runner and reused for every frame.
+    """
+    return {
+            'x': (np.arange(street._lane_len, dtype=int) * METERS_PER_CELL), # cells
+            'y': np.arange(street._lanes, dtype=int) # lanes
+        }
+
+@functools.lru_cache(maxsize=8)
+def _empty_state(shape: tuple) -> np.ndarray:
+    """
+    Returns a read-only street of the given shape without any cars.
+    """
+    empty_state = np.full(shape, -1, dtype=np.int8)
+    empty_state.flags.writeable = False
+    return empty_state
+
+def gridded_data_from(state: np.ndarray, x_axis: np.ndarray, y_axis: np.ndarray, empty=False) -> dict:
+    if empty:
+        state = _empty_state(state.shape)
+    # C-contiguous int8 so bokeh transfers it as a binary array instead of a JSON list,
+    # read-only view, so the history is never copied or mutated on its way to bokeh
+    z = np.ascontiguousarray(state, dtype=np.int8).view()
+    z.flags.writeable = False
     return {
-            'y': np.arange(state.shape[0], dtype=int), # lanes
-            'x': (np.arange(state.shape[1], dtype=int) * METERS_PER_CELL), # cells
-            'z': state if not empty else (np.zeros_like(state, dtype=int) - 1) # speed
+            'y': y_axis, # lanes
+            'x': x_axis, # cells
+            'z': z # speed
         }
 
+@functools.lru_cache(maxsize=32)
+def _build_colormap(velocity_max: int) -> tuple:
+    """
+    Returns the colormap, color levels and colorbar ticks for the given maximum velocity.
+    The result only depends on `velocity_max`, so it is cached across plot rebuilds.
+    """
+    custom_colormap = ['#cccccc'] + _BGY_ARR[np.linspace(0, (len(_BGY_ARR) - 1), (velocity_max + 1), dtype=int)].tolist()
+    color_levels = (np.arange(-1, (velocity_max + 2)) - 0.5).tolist()
+    colorbar_ticks = np.arange(-1, (velocity_max + 1)).tolist()
+    return tuple(custom_colormap), tuple(color_levels), tuple(colorbar_ticks)
+
+@functools.lru_cache(maxsize=8)
+def _throughput_overlay(lane_len: int) -> hv.Overlay:
+    """
+    Returns the line and label marking the throughput measurement stretch of the street.
+    """
+    last_10_percent_idx = int(lane_len * 0.9) * METERS_PER_CELL
+    last_10_percent_line = hv.VLine(last_10_percent_idx)
+    last_10_percent_line.opts(color='black', line_width=1)
+    text = hv.Text(last_10_percent_idx, -0.4, ' throughput measurement')
+    text.opts(text_font_size='8pt', text_color='black', text_align='left')
+    return last_10_percent_line * text
+
 def prepare_street_plot(runner: Runner, gridded_data_pipe: Pipe) -> hv.DynamicMap:
     
     # parameters defining the street
@@ -36,10 +93,7 @@ def prepare_street_plot(runner: Runner, gridded_data_pipe: Pipe) -> hv.DynamicMa
     velocity_max = runner._street._v_max
     
     # parameters defining the color mapping of car speeds
-    color_map = cc.bgy
-    custom_colormap = ['#cccccc'] + [color_map[i] for i in np.linspace(0, (len(color_map) - 1), (velocity_max + 1), dtype=int)]
-    color_levels = (np.arange(-1, (velocity_max + 2)) - 0.5).tolist()
-    colorbar_ticks = np.arange(-1, (velocity_max + 1)).tolist()
+    custom_colormap, color_levels, colorbar_ticks = _build_colormap(velocity_max)
 
     heatmap_dmap = hv.DynamicMap(
         hv.HeatMap,
@@ -55,13 +109,7 @@ def prepare_street_plot(runner: Runner, gridded_data_pipe: Pipe) -> hv.DynamicMa
     heatmap_dmap = heatmap_dmap
     
     
-    last_10_percent_idx = int(lane_len * 0.9) * METERS_PER_CELL
-    last_10_percent_line = hv.VLine(last_10_percent_idx)
-    last_10_percent_line.opts(color='black', line_width=1)
-    text = hv.Text(last_10_percent_idx, -0.4, ' throughput measurement')
-    text.opts(text_font_size='8pt', text_color='black', text_align='left')
-    
-    street_plot = heatmap_dmap * last_10_percent_line * text
+    street_plot = heatmap_dmap * _throughput_overlay(lane_len)
     street_plot.opts(
         hv.opts.Curve(default_tools=[]),
         hv.opts.HeatMap(
@@ -70,10 +118,10 @@ def prepare_street_plot(runner: Runner, gridded_data_pipe: Pipe) -> hv.DynamicMa
             max_height=400,
             default_tools=['reset'],
             #toolbar=None,
-            cmap=custom_colormap,
-            color_levels=color_levels,
+            cmap=list(custom_colormap),
+            color_levels=list(color_levels),
             colorbar=True,
-            colorbar_opts={ 'ticker': FixedTicker(ticks=colorbar_ticks) },
+            colorbar_opts={ 'ticker': FixedTicker(ticks=list(colorbar_ticks)) },
         )
     )
     
@@ -121,15 +169,13 @@ def prepare_metric_plot(runner: Runner, timestep_player) -> hv.DynamicMap:
     
     return plot
 
-def create_simulation_parameter_info_card(
-        runner: Runner
-) -> pn.Card:
+def simulation_parameter_info_from(runner: Runner) -> tuple:
     """
-    Creates a Card containing information about the runner's simulation parameters.
+    Returns the Markdown texts describing the runner's street, rules and simulation parameters.
     """
     
     if runner is None:
-        return pn.pane.Markdown('')
+        return '', '', ''
     
     street = runner._street
     rules = runner._rule_list
@@ -140,17 +186,11 @@ def create_simulation_parameter_info_card(
     rules_text = '### Rules'
     
     for rule in rules:
-        rules_text += f'\n- {rule.__class__.__name__}: {rule.__dict__}'
+        rules_text += f'\n- {rule!r}'
         
     simulation_text = f'\n### Simulation\n- Random seed: {runner._street._seed}\n- Timesteps: {len(runner.history)}'
     
-    return pn.Card(
-        pn.Row(
-            pn.pane.Markdown(params_text, sizing_mode='stretch_width'), 
-            pn.pane.Markdown(rules_text, sizing_mode='stretch_width'),
-            pn.pane.Markdown(simulation_text, sizing_mode='stretch_width'),
-            sizing_mode='stretch_width'),
-        title='Parameters', sizing_mode='stretch_width')
+    return params_text, rules_text, simulation_text
 
 
 class TrafficSimulationUI:
@@ -158,8 +198,8 @@ class TrafficSimulationUI:
     def __init__(self):
         self.ui = pn.template.MaterialTemplate(title='Traffic Simulation')
         
-        # Sidebar contents
-        self.ui.sidebar.append(pn.pane.Markdown('# Settings'))
+        # Sidebar contents, collected first and added to the template at once
+        sidebar_items = [pn.pane.Markdown('# Settings')]
         
         # Street parameter input widgets
         self.lane_len = pn.widgets.IntSlider(
@@ -181,7 +221,7 @@ class TrafficSimulationUI:
             value=20,
             end=100)
         
-        self.ui.sidebar.append(
+        sidebar_items.append(
             pn.WidgetBox(
                 '## Street',
                 self.lane_len,
@@ -220,7 +260,7 @@ class TrafficSimulationUI:
         self.merge_back_checkbox = pn.widgets.Checkbox(name='Merge back', value=True)
         
         spacer_height = 15
-        self.ui.sidebar.append(
+        sidebar_items.append(
             pn.WidgetBox(
                 '## Rules',
                 self.accelerate_checkbox,
@@ -252,7 +292,7 @@ class TrafficSimulationUI:
         self.simulation_progressb_bar = pn.widgets.Tqdm(text='Progress', sizing_mode='stretch_width', width_policy='max')
         self.run_simulation_button.on_click(self.run_simulation)
         
-        self.ui.sidebar.append(
+        sidebar_items.append(
             pn.WidgetBox(
                 '## Simulation',
                 self.random_seed,
@@ -260,6 +300,7 @@ class TrafficSimulationUI:
                 pn.Spacer(height=spacer_height),
                 self.run_simulation_button,
                 self.simulation_progressb_bar))
+        self.ui.sidebar.extend(sidebar_items)
         
         # Main contents
         
@@ -273,12 +314,19 @@ class TrafficSimulationUI:
                 []
             )
         self.current_runner = CurrentRunner(value=initial_runner)
-        self.gridded_data_pipe = Pipe(data=gridded_data_from(initial_runner._street._state, empty=True))
+        self._axes_cache = gridded_axes_from(initial_runner._street)
+        self.gridded_data_pipe = Pipe(data=gridded_data_from(
+            initial_runner._street._state,
+            self._axes_cache['x'],
+            self._axes_cache['y'],
+            empty=True))
         
         self.export_simulation_button = pn.widgets.FileDownload(
             None,
             align='center')
         self.export_simulation_button.disabled = True
+        self._export_future = None
+        self._last_simulation_parameters = None
         self.export_simulation_button.aspect_ratio = 12
         
         self.timestep_player = pn.widgets.DiscretePlayer(
@@ -298,13 +346,23 @@ class TrafficSimulationUI:
             runner=self.current_runner.param.value,
             timestep_player=[self.timestep_player])
         
-        self.run_parameter_info = pn.bind(
-            create_simulation_parameter_info_card,
-            runner=self.current_runner.param.value)
+        # the info card is built once, its Markdown panes are updated in place on runner change
+        self._params_md = pn.pane.Markdown(sizing_mode='stretch_width')
+        self._rules_md = pn.pane.Markdown(sizing_mode='stretch_width')
+        self._sim_md = pn.pane.Markdown(sizing_mode='stretch_width')
+        self.run_parameter_info = pn.Card(
+            pn.Row(
+                self._params_md,
+                self._rules_md,
+                self._sim_md,
+                sizing_mode='stretch_width'),
+            title='Parameters', sizing_mode='stretch_width')
+        self.refresh_run_parameter_info()
+        self.current_runner.param.watch(self.refresh_run_parameter_info, 'value')
         
-        @pn.depends(timestep=self.timestep_player, watch=True)
-        def on_timestep_player_change(timestep):
-            self.gridded_data_pipe.send(gridded_data_from(self.current_runner.value.history[timestep]))
+        self._pending_timestep = None
+        self._send_scheduled = False
+        self.timestep_player.param.watch(self.on_timestep_player_change, 'value')
 
         self.ui.main.extend([
             pn.Column(
@@ -322,10 +380,76 @@ class TrafficSimulationUI:
     def get_user_interface(self):
         return self.ui
 
+    def refresh_run_parameter_info(self, event: Any = None) -> None:
+        """
+        Updates the parameter info card with the current runner's parameters.
+        """
+        params_text, rules_text, simulation_text = simulation_parameter_info_from(self.current_runner.value)
+        self._params_md.object = params_text
+        self._rules_md.object = rules_text
+        self._sim_md.object = simulation_text
+
+    def on_timestep_player_change(self, event: Any) -> None:
+        """
+        Schedules sending the new timestep to the street plot. Ticks arriving
+        within the throttle window are coalesced, only the latest one is sent.
+        """
+        self._pending_timestep = event.new
+        if self._send_scheduled:
+            return
+        doc = pn.state.curdoc
+        if doc is None or doc.session_context is None:
+            # without a server session timeout callbacks never fire, so send right away
+            self.send_pending_timestep()
+            return
+        # a one-shot document timeout, unlike pn.state.add_periodic_callback it is not kept registered
+        self._send_scheduled = True
+        doc.add_timeout_callback(self.send_pending_timestep, TIMESTEP_THROTTLE_MS)
+
+    def send_pending_timestep(self) -> None:
+        self._send_scheduled = False
+        timestep, self._pending_timestep = self._pending_timestep, None
+        if timestep is None:
+            return
+        self.gridded_data_pipe.send(gridded_data_from(
+            self.current_runner.value.history[timestep],
+            self._axes_cache['x'],
+            self._axes_cache['y']))
+
+    def export_simulation(self) -> io.BytesIO:
+        """
+        Returns the current simulation serialized in the background, waiting for it if it is not done yet.
+        """
+        return io.BytesIO(self._export_future.result())
+
+    def simulation_parameters(self) -> tuple:
+        """
+        Returns the values of all widgets that influence the simulation result.
+        """
+        return (
+            self.lanes.value,
+            self.lane_len.value,
+            self.n_cars.value,
+            self.v_max.value,
+            self.random_seed.value,
+            self.simulation_length.value,
+            self.accelerate_checkbox.value,
+            self.avoid_collision_checkbox.value,
+            self.dawdling_checkbox.value,
+            self.dawdling_factor.value,
+            self.move_forward_checkbox.value,
+            self.merge_back_checkbox.value)
+
     def run_simulation(self, event: Any) -> None:
         """
         Runs the simulation.
+        Clicking again without changing any parameter replays the current simulation instead.
         """
+        parameters = self.simulation_parameters()
+        if parameters == self._last_simulation_parameters:
+            self.timestep_player.value = self.timestep_player.options[0]
+            return
+        
         try:
             
             street = Street(self.lanes.value, self.lane_len.value, self.n_cars.value, self.v_max.value, self.random_seed.value)
@@ -344,19 +468,29 @@ class TrafficSimulationUI:
             runner = Runner(street, rules, self.simulation_length.value)
             
             runner.run(tqdm_widget=self.simulation_progressb_bar)
+            # store the history as one contiguous (timesteps, lanes, lane_len) array,
+            # so that indexing a timestep is a view and serializing it is a single buffer
+            runner.history = np.stack(runner.history, dtype=np.int8)
 
         except Exception as e:
             pn.state.notifications.error(f'Simulation failed: {e}. Details in console.', duration=10000)
             raise e
             
+        # push the first frame through the pipe before the plot is rebuilt for the new runner,
+        # the player does not emit a change if its value stays the same
+        self._axes_cache = gridded_axes_from(runner._street)
+        # drop a throttled timestep of the previous runner, it may be out of range for the new history
+        self._pending_timestep = None
+        self.gridded_data_pipe.send(gridded_data_from(
+            runner.history[0],
+            self._axes_cache['x'],
+            self._axes_cache['y']))
+        self._export_future = _export_executor.submit(runner.serialize)
         self.current_runner.value = runner
-        
-        file = io.BytesIO()
-        file.write(runner.serialize())
-        file.seek(0)
+        self._last_simulation_parameters = parameters
         
         self.export_simulation_button.filename = f'traffic_jam_simulation_{datetime.now().strftime("%Y%m%d_%H%M%S")}.bin'
-        self.export_simulation_button.file = file
+        self.export_simulation_button.callback = self.export_simulation
         self.export_simulation_button.disabled = False
         self.export_simulation_button.button_type = 'primary'
         